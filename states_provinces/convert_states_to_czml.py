@@ -4,14 +4,141 @@ Convert Natural Earth states/provinces shapefiles to CZML format.
 Processes 10m, 50m, and 110m resolutions.
 """
 
-import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from czml_io import coords_to_cartographic_radians, open_czml
 import fiona
-from shapely.geometry import shape
-import math
+import hashlib
+import numpy as np
+import orjson
 import os
 import sys
 
-def convert_shapefile_to_czml(shapefile_path, output_czml_path, resolution_name):
+# Only the attributes used for packet ids and labels are read from the shapefile
+LABEL_FIELDS = ['name', 'NAME', 'admin', 'ADMIN']
+
+def lonlat_array(coords):
+    """Return ring coordinates as an (N, 2) float64 array of (lon, lat), dropping any Z."""
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.size == 0:
+        return np.empty((0, 2))
+    return coords[:, :2]
+
+def build_polyline_packet(packet_id, coords, label_text):
+    """
+    Build a CZML polyline packet from (lon, lat) coordinates in degrees.
+    
+    Args:
+        packet_id: CZML packet id
+        coords: Sequence or array of (lon, lat) coordinates in degrees
+        label_text: Text for the packet label, or None for no label
+    """
+    # Convert coordinates to cartographic radians (vectorized)
+    lonlat = lonlat_array(coords)
+    cartographic_radians = coords_to_cartographic_radians(lonlat * (np.pi / 180.0))
+    
+    packet = {
+        "id": packet_id,
+        "polyline": {
+            "positions": {
+                "cartographicRadians": cartographic_radians
+            },
+            "material": {
+                "solidColor": {
+                    "color": {
+                        "rgba": [255, 255, 255, 255]
+                    }
+                }
+            },
+            "width": 1,
+            "clampToGround": True
+        }
+    }
+    
+    if label_text:
+        packet["label"] = {
+            "text": label_text
+        }
+    
+    return packet
+
+def split_shared_borders(rings):
+    """
+    Split rings into border edges and merge edges shared between features.
+    
+    Natural Earth stores both sides of a shared border independently. Each
+    ring is cut at topological junctions (vertices with other than two
+    distinct neighbours across all rings), and every resulting edge is
+    hashed by its rounded coordinates in a direction-independent way, so a
+    border shared by two features is kept only once and carries both labels.
+    
+    Args:
+        rings: List of (packet_id, label_text, coords) tuples, with coords
+               in degrees
+    
+    Returns:
+        List of (packet_id, [label_text, ...], coords) tuples, one per edge
+    """
+    # Empty rings have no border to share
+    rings = [ring for ring in rings if len(ring[2])]
+    if not rings:
+        return []
+    
+    arrays = [lonlat_array(coords) for _, _, coords in rings]
+    lengths = np.array([len(arr) for arr in arrays])
+    all_xy = np.concatenate(arrays)
+    
+    # Quantize to ~1 cm so that identical vertices from different rings match
+    quantized = np.round(all_xy * 1e7).astype(np.int64)
+    _, vertex_ids = np.unique(quantized, axis=0, return_inverse=True)
+    vertex_ids = vertex_ids.ravel()
+    
+    # Count distinct neighbours of each vertex across all rings
+    ring_starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    is_last = np.zeros(len(vertex_ids), dtype=bool)
+    is_last[ring_starts + lengths - 1] = True
+    a = vertex_ids[:-1][~is_last[:-1]]
+    b = vertex_ids[1:][~is_last[:-1]]
+    segments = np.stack((np.minimum(a, b), np.maximum(a, b)), axis=1)
+    segments = np.unique(segments[segments[:, 0] != segments[:, 1]], axis=0)
+    degree = np.bincount(segments.ravel(), minlength=vertex_ids.max() + 1)
+    is_junction = degree != 2
+    
+    edges = []
+    edge_index = {}
+    
+    for (packet_id, label_text, _), xy, start, length in zip(rings, arrays, ring_starts, lengths):
+        ids = vertex_ids[start:start + length]
+        ring_q = quantized[start:start + length]
+        closed = length > 1 and ids[0] == ids[-1]
+        cuts = np.flatnonzero(is_junction[ids])
+        
+        if closed and len(cuts) and cuts[0] != 0:
+            # Rotate the closed ring so that it starts on a junction
+            order = np.concatenate((np.arange(cuts[0], length - 1), np.arange(0, cuts[0] + 1)))
+            ids, ring_q, xy = ids[order], ring_q[order], xy[order]
+            cuts = np.flatnonzero(is_junction[ids])
+        
+        cuts = np.union1d(cuts, [0, length - 1])
+        
+        for edge_idx, (i, j) in enumerate(zip(cuts[:-1], cuts[1:])):
+            edge_q = ring_q[i:j + 1]
+            forward = edge_q.tobytes()
+            backward = edge_q[::-1].tobytes()
+            key = hashlib.blake2b(min(forward, backward), digest_size=16).digest()
+            
+            if key in edge_index:
+                labels = edges[edge_index[key]][1]
+                if label_text not in labels:
+                    labels.append(label_text)
+            else:
+                edge_index[key] = len(edges)
+                edges.append((f"{packet_id}_{edge_idx}", [label_text], xy[i:j + 1]))
+    
+    return edges
+
+def convert_shapefile_to_czml(shapefile_path, output_czml_path, resolution_name,
+                              dedupe_borders=False, compress=False, seq=False):
     """
     Convert shapefile to CZML format with polylines.
     
@@ -19,28 +146,48 @@ def convert_shapefile_to_czml(shapefile_path, output_czml_path, resolution_name)
         shapefile_path: Path to input shapefile
         output_czml_path: Path to output CZML file
         resolution_name: Name of resolution (e.g., "10m", "50m", "110m")
+        dedupe_borders: Emit borders shared by adjacent features only once
+                        (see split_shared_borders). Rings are held in memory
+                        until all features are read.
+        compress: Write gzip-compressed output to output_czml_path + '.gz'
+        seq: Write a CZML text sequence (one packet per line) instead of a
+             single JSON array, so consumers can parse packet by packet
     """
+    if compress:
+        output_czml_path += '.gz'
+    
     print(f"\n{'='*60}")
     print(f"Converting {resolution_name} States/Provinces to CZML")
     print(f"{'='*60}")
     print(f"Reading shapefile: {shapefile_path}")
     
-    # Initialize CZML document
-    czml_data = [
-        {
-            "id": "document",
-            "name": f"States and Provinces Borders {resolution_name}",
-            "version": "1.0"
-        }
-    ]
+    # CZML document packet
+    document_packet = {
+        "id": "document",
+        "name": f"States and Provinces Borders {resolution_name}",
+        "version": "1.0"
+    }
     
-    # Read shapefile
+    # Array output is "[doc,packet,...]"; sequence output is one packet per line
+    if seq:
+        head, separator, tail = b'', b'\n', b'\n'
+    else:
+        head, separator, tail = b'[', b',', b']'
+    
+    # Stream packets to a temporary sibling file (keeping the .gz suffix) and
+    # move it onto the output path only once the whole conversion succeeded
+    root, ext = os.path.splitext(output_czml_path)
+    partial_path = f"{root}.part{ext}"
+    
+    # Read shapefile and stream packets to the output file as they are built
     try:
-        with fiona.open(shapefile_path) as src:
-            print(f"Found {len(src)} features")
+        with fiona.open(shapefile_path, include_fields=LABEL_FIELDS) as src, \
+                open_czml(partial_path, 'wb') as f:
+            f.write(head + orjson.dumps(document_packet))
             
             feature_count = 0
             polyline_count = 0
+            rings = []
             
             for feature in src:
                 feature_count += 1
@@ -50,72 +197,65 @@ def convert_shapefile_to_czml(shapefile_path, output_czml_path, resolution_name)
                 name = props.get('name', props.get('NAME', f'Feature_{feature_count}'))
                 admin = props.get('admin', props.get('ADMIN', 'Unknown'))
                 
-                # Get geometry
-                geom = shape(feature['geometry'])
+                # Get geometry coordinates directly from the GeoJSON-like record
+                geom = feature['geometry']
+                geom_type = geom['type']
                 
-                # Handle different geometry types
-                if geom.geom_type == 'Polygon':
-                    coords_list = [geom.exterior.coords]
-                elif geom.geom_type == 'MultiPolygon':
-                    coords_list = [poly.exterior.coords for poly in geom.geoms]
-                elif geom.geom_type == 'LineString':
-                    coords_list = [geom.coords]
-                elif geom.geom_type == 'MultiLineString':
-                    coords_list = [line.coords for line in geom.geoms]
+                # Handle different geometry types (exterior rings only for polygons)
+                if geom_type == 'Polygon':
+                    coords_list = [geom['coordinates'][0]]
+                elif geom_type == 'MultiPolygon':
+                    coords_list = [poly[0] for poly in geom['coordinates']]
+                elif geom_type == 'LineString':
+                    coords_list = [geom['coordinates']]
+                elif geom_type == 'MultiLineString':
+                    coords_list = list(geom['coordinates'])
                 else:
-                    print(f"Skipping unsupported geometry type: {geom.geom_type}")
+                    print(f"Skipping unsupported geometry type: {geom_type}")
                     continue
                 
                 # Create CZML polylines for each coordinate list
+                label_text = f"{name}, {admin}"
                 for idx, coords in enumerate(coords_list):
                     polyline_count += 1
+                    packet_id = f"{name}_{admin}_{feature_count}_{idx}"
                     
-                    # Convert coordinates to cartographic radians
-                    cartographic_radians = []
-                    for lon, lat in coords:
-                        lon_rad = math.radians(lon)
-                        lat_rad = math.radians(lat)
-                        cartographic_radians.extend([lon_rad, lat_rad, 0])
-                    
-                    # Create CZML packet
-                    czml_packet = {
-                        "id": f"{name}_{admin}_{feature_count}_{idx}",
-                        "polyline": {
-                            "positions": {
-                                "cartographicRadians": cartographic_radians
-                            },
-                            "material": {
-                                "solidColor": {
-                                    "color": {
-                                        "rgba": [255, 255, 255, 255]
-                                    }
-                                }
-                            },
-                            "width": 1,
-                            "clampToGround": True
-                        },
-                        "label": {
-                            "text": f"{name}, {admin}"
-                        }
-                    }
+                    if dedupe_borders:
+                        rings.append((packet_id, label_text, coords))
+                        continue
                     
-                    czml_data.append(czml_packet)
+                    # Label only the first ring so each feature gets a single billboard
+                    czml_packet = build_polyline_packet(packet_id, coords,
+                                                        label_text if idx == 0 else None)
+                    f.write(separator + orjson.dumps(czml_packet))
                 
                 if feature_count % 100 == 0:
-                    print(f"Processed {feature_count} features, {polyline_count} polylines...")
+                    print(f"[{resolution_name}] Processed {feature_count} features, {polyline_count} polylines...")
+            
+            if dedupe_borders:
+                print(f"\n[{resolution_name}] Merging shared borders across {len(rings)} rings...")
+                edges = split_shared_borders(rings)
+                polyline_count = len(edges)
+                
+                # Label each feature only on the first edge it appears on
+                labelled = set()
+                for packet_id, labels, coords in edges:
+                    new_labels = [text for text in labels if text not in labelled]
+                    labelled.update(new_labels)
+                    czml_packet = build_polyline_packet(packet_id, coords, " / ".join(new_labels))
+                    f.write(separator + orjson.dumps(czml_packet))
+            
+            f.write(tail)
         
-        print(f"\nTotal features processed: {feature_count}")
-        print(f"Total polylines created: {polyline_count}")
+        os.replace(partial_path, output_czml_path)
         
-        # Write CZML file
-        print(f"\nWriting CZML to: {output_czml_path}")
-        with open(output_czml_path, 'w') as f:
-            json.dump(czml_data, f, separators=(',', ':'))
+        print(f"\n[{resolution_name}] Total features processed: {feature_count}\n"
+              f"[{resolution_name}] Total polylines created: {polyline_count}")
         
         # Get file size
         size_mb = os.path.getsize(output_czml_path) / (1024 * 1024)
         print(f"✓ CZML file created: {output_czml_path} ({size_mb:.1f} MB)")
-        print(f"✓ Contains {len(czml_data)} packets ({len(czml_data)-1} polylines)")
+        print(f"✓ Contains {polyline_count + 1} packets ({polyline_count} polylines)")
         
         return {
             'resolution': resolution_name,
@@ -127,9 +267,35 @@ def convert_shapefile_to_czml(shapefile_path, output_czml_path, resolution_name)
         
     except Exception as e:
         print(f"ERROR converting {resolution_name}: {e}")
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        return None
+
+def convert_one(conv):
+    """Run a single conversion from main(); executed in a worker process."""
+    if not os.path.exists(conv['shapefile']):
+        print(f"\nWARNING: Shapefile not found: {conv['shapefile']}")
         return None
+    
+    return convert_shapefile_to_czml(
+        conv['shapefile'],
+        conv['output'],
+        conv['resolution'],
+        dedupe_borders=conv['dedupe_borders'],
+        compress=conv['compress'],
+        seq=conv['seq']
+    )
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dedupe-borders', action='store_true',
+                        help='emit borders shared by adjacent states/provinces only once')
+    parser.add_argument('--gzip', action='store_true',
+                        help='write gzip-compressed .czml.gz files')
+    parser.add_argument('--seq', action='store_true',
+                        help='write CZML text sequences (.czmls, one packet per line)')
+    args = parser.parse_args()
+    
     print("="*60)
     print("NATURAL EARTH STATES/PROVINCES TO CZML CONVERTER")
     print("Converting All Resolutions: 10m, 50m, 110m")
@@ -154,22 +320,16 @@ def main():
         }
     ]
     
-    results = []
-    
-    # Convert each resolution
     for conv in conversions:
-        if not os.path.exists(conv['shapefile']):
-            print(f"\nWARNING: Shapefile not found: {conv['shapefile']}")
-            continue
-        
-        result = convert_shapefile_to_czml(
-            conv['shapefile'],
-            conv['output'],
-            conv['resolution']
-        )
-        
-        if result:
-            results.append(result)
+        conv['dedupe_borders'] = args.dedupe_borders
+        conv['compress'] = args.gzip
+        conv['seq'] = args.seq
+        if args.seq:
+            conv['output'] += 's'
+    
+    # Convert each resolution in its own process
+    with ProcessPoolExecutor(max_workers=len(conversions)) as executor:
+        results = [result for result in executor.map(convert_one, conversions) if result]
     
     # Summary
     print("\n" + "="*60)
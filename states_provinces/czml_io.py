@@ -0,0 +1,31 @@
+"""
+Shared CZML file helpers and settings used by convert_states_to_czml.py and
+optimize_czml.py.
+"""
+
+import gzip
+import numpy as np
+
+# Decimal places kept for radian coordinates. 1e-7 rad is ~0.64 m on the
+# ground, far finer than the 1:10m source data and Cesium's rendering of it,
+# while cutting each number from ~18 to ~10 characters of JSON.
+COORDINATE_DECIMALS = 7
+
+def open_czml(path, mode='rb'):
+    """Open a CZML file, transparently gzip-(de)compressing paths ending in .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
+def coords_to_cartographic_radians(coords):
+    """
+    Convert an (N, 2) array of (lon, lat) radians to a flat cartographicRadians list.
+    
+    Coordinates are rounded to COORDINATE_DECIMALS and heights are written
+    as integer 0, so every script encodes positions the same way.
+    """
+    radians = np.round(np.asarray(coords, dtype=np.float64).reshape(-1, 2), COORDINATE_DECIMALS)
+    cartographic_radians = [0] * (3 * len(radians))
+    cartographic_radians[0::3] = radians[:, 0].tolist()
+    cartographic_radians[1::3] = radians[:, 1].tolist()
+    return cartographic_radians
@@ -4,128 +4,336 @@ Optimize CZML files by simplifying polylines while maintaining visual quality.
 Uses Douglas-Peucker algorithm for line simplification.
 """
 
-import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from czml_io import coords_to_cartographic_radians, open_czml
 import math
-from shapely.geometry import LineString
-from shapely import simplify
+import mmap
+from numba import njit
+import numpy as np
+import orjson
+import shapely
 import os
 
+# Number of polylines handed to a worker process per task
+POLYLINES_PER_CHUNK = 256
+
+# Polylines shorter than this are simplified with the Numba Douglas-Peucker;
+# longer ones go through GEOS, which is faster at scale
+NUMBA_DP_MAX_POINTS = 256
+
+# Polylines with at most this many points are passed through unsimplified
+MIN_SIMPLIFY_POINTS = 4
+
+def load_czml(path):
+    """
+    Load a CZML JSON array.
+    
+    Plain files are memory-mapped and parsed by orjson straight from the
+    mapped buffer, avoiding an intermediate copy of the file contents.
+    """
+    if path.endswith('.gz'):
+        with open_czml(path, 'rb') as f:
+            return orjson.loads(f.read())
+    
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        with memoryview(mm) as buffer:
+            return orjson.loads(buffer)
+
+def iter_czml_seq(path):
+    """Yield packets from a CZML text sequence (one JSON packet per line)."""
+    with open_czml(path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
 def cartographic_radians_to_coords(radians_list):
-    """Convert flat list of cartographic radians to list of (lon, lat) tuples."""
-    coords = []
-    for i in range(0, len(radians_list), 3):
-        lon_rad = radians_list[i]
-        lat_rad = radians_list[i + 1]
-        coords.append((lon_rad, lat_rad))
-    return coords
-
-def coords_to_cartographic_radians(coords):
-    """Convert list of (lon, lat) tuples to flat list of cartographic radians."""
-    radians = []
-    for lon_rad, lat_rad in coords:
-        radians.extend([lon_rad, lat_rad, 0])
-    return radians
-
-def simplify_polyline(coords, tolerance):
+    """Convert flat list of cartographic radians to an (N, 2) array of (lon, lat)."""
+    return np.asarray(radians_list, dtype=np.float64).reshape(-1, 3)[:, :2]
+
+@njit(cache=True)
+def farthest_point(points, start, end):
+    """Return (index, squared distance) of the point farthest from segment start-end."""
+    ax = points[start, 0]
+    ay = points[start, 1]
+    dx = points[end, 0] - ax
+    dy = points[end, 1] - ay
+    seg_len_sq = dx * dx + dy * dy
+    
+    max_dist_sq = -1.0
+    index = start
+    for i in range(start + 1, end):
+        px = points[i, 0] - ax
+        py = points[i, 1] - ay
+        if seg_len_sq > 0.0:
+            t = (px * dx + py * dy) / seg_len_sq
+            t = min(max(t, 0.0), 1.0)
+            px -= t * dx
+            py -= t * dy
+        dist_sq = px * px + py * py
+        if dist_sq > max_dist_sq:
+            max_dist_sq = dist_sq
+            index = i
+    
+    return index, max_dist_sq
+
+@njit(cache=True)
+def douglas_peucker(points, tolerance, max_vertices=0):
     """
-    Simplify a polyline using Douglas-Peucker algorithm.
+    Simplify an (N, 2) array with a Douglas-Peucker that can cap vertex count.
+    
+    Pending segments are split in order of decreasing distance of their
+    farthest point, so stopping early once max_vertices points are kept
+    leaves the most significant vertices. Without a cap the result is the
+    same as classic Douglas-Peucker. Point-to-segment distance is used,
+    matching the GEOS simplifier used for longer polylines.
     
     Args:
-        coords: List of (lon, lat) tuples in radians
+        points: (N, 2) float64 array of (lon, lat) in radians
+        tolerance: Simplification tolerance in radians
+        max_vertices: Maximum number of points to keep (0 = no limit)
+    
+    Returns:
+        Simplified (N, 2) array of (lon, lat)
+    """
+    n = points.shape[0]
+    if n < 3:
+        return points.copy()
+    
+    keep = np.zeros(n, dtype=np.bool_)
+    keep[0] = True
+    keep[n - 1] = True
+    kept = 2
+    
+    # Pending segments: start, end, farthest point and its squared distance
+    tolerance_sq = tolerance * tolerance
+    seg_start = np.empty(n, dtype=np.int64)
+    seg_end = np.empty(n, dtype=np.int64)
+    seg_index = np.empty(n, dtype=np.int64)
+    seg_dist_sq = np.empty(n, dtype=np.float64)
+    
+    seg_start[0] = 0
+    seg_end[0] = n - 1
+    seg_index[0], seg_dist_sq[0] = farthest_point(points, 0, n - 1)
+    pending = 1
+    
+    while pending > 0 and (max_vertices <= 0 or kept < max_vertices):
+        best = 0
+        for s in range(1, pending):
+            if seg_dist_sq[s] > seg_dist_sq[best]:
+                best = s
+        
+        if seg_dist_sq[best] <= tolerance_sq:
+            break
+        
+        start = seg_start[best]
+        end = seg_end[best]
+        index = seg_index[best]
+        keep[index] = True
+        kept += 1
+        
+        # Replace the split segment with its two halves, dropping trivial ones
+        pending -= 1
+        seg_start[best] = seg_start[pending]
+        seg_end[best] = seg_end[pending]
+        seg_index[best] = seg_index[pending]
+        seg_dist_sq[best] = seg_dist_sq[pending]
+        
+        for a, b in ((start, index), (index, end)):
+            if b - a >= 2:
+                seg_start[pending] = a
+                seg_end[pending] = b
+                seg_index[pending], seg_dist_sq[pending] = farthest_point(points, a, b)
+                pending += 1
+    
+    return points[keep]
+
+def simplify_polylines(coords_list, tolerance, max_vertices=None):
+    """
+    Simplify many polylines at once.
+    
+    Short polylines go through the Numba Douglas-Peucker, skipping the
+    LineString construction and GEOS round trip that dominate their cost,
+    as do all polylines when max_vertices is set (GEOS cannot cap the
+    vertex count). The rest are simplified together in a single vectorized
+    Shapely call. Plain Douglas-Peucker is used (no topology preservation),
+    which is safe for the non-self-intersecting rings of Natural Earth admin
+    borders; callers that need topology invariants should split
+    MultiPolygons into single rings beforehand.
+    
+    Args:
+        coords_list: List of polylines, each an (N, 2) array of (lon, lat) in radians
         tolerance: Simplification tolerance in radians (smaller = more detail)
+        max_vertices: Optional cap on the number of points kept per polyline
     
     Returns:
-        Simplified list of (lon, lat) tuples
+        List of simplified (N, 2) coordinate arrays, in input order
     """
-    if len(coords) < 3:
-        return coords
+    simplified_list = [None] * len(coords_list)
+    large = []
+    
+    for i, coords in enumerate(coords_list):
+        if max_vertices or len(coords) < NUMBA_DP_MAX_POINTS:
+            points = np.ascontiguousarray(coords, dtype=np.float64)
+            simplified_list[i] = douglas_peucker(points, tolerance, max_vertices or 0)
+        else:
+            large.append(i)
     
-    # Create LineString and simplify
-    line = LineString(coords)
-    simplified = simplify(line, tolerance=tolerance, preserve_topology=True)
+    if large:
+        # Build all LineStrings in one C call from a flat coordinate buffer
+        all_xy = np.concatenate([coords_list[i] for i in large])
+        indices = np.repeat(np.arange(len(large)), [len(coords_list[i]) for i in large])
+        lines = shapely.linestrings(all_xy, indices=indices)
+        simplified = shapely.simplify(lines, tolerance=tolerance, preserve_topology=False)
+        
+        coords, index = shapely.get_coordinates(simplified, return_index=True)
+        counts = np.bincount(index, minlength=len(lines))
+        for i, simplified_coords in zip(large, np.split(coords, np.cumsum(counts)[:-1])):
+            simplified_list[i] = simplified_coords
     
-    return list(simplified.coords)
+    return simplified_list
+
+def polyline_radians(packet):
+    """Return a packet's flat cartographicRadians list, or None if it has none."""
+    if 'polyline' in packet and 'positions' in packet['polyline']:
+        return packet['polyline']['positions'].get('cartographicRadians')
+    return None
 
-def optimize_czml(input_file, output_file, tolerance, target_name):
+def needs_simplify(n, max_vertices=None):
+    """
+    Whether a polyline of n points should be simplified.
+    
+    Lines of at most MIN_SIMPLIFY_POINTS points have nothing worth removing
+    and are kept as-is, unless they still exceed the vertex cap.
+    """
+    return n > MIN_SIMPLIFY_POINTS or bool(max_vertices and n > max_vertices)
+
+def simplify_chunk(coords_list, tolerance, max_vertices=None):
+    """Simplify one chunk of polylines; executed in a worker process."""
+    return simplify_polylines(coords_list, tolerance, max_vertices)
+
+def optimize_czml(input_file, output_file, tolerance, target_name, workers=None,
+                  compress=False, seq=False, max_vertices=None):
     """
     Optimize CZML file by simplifying polylines.
     
     Args:
-        input_file: Input CZML file path
+        input_file: Input CZML file path (gzip-compressed if it ends in .gz)
         output_file: Output CZML file path
         tolerance: Simplification tolerance in radians
         target_name: Name for the optimized dataset
+        workers: Number of worker processes for simplification
+                 (default: CPU count, 1 disables the process pool)
+        compress: Write gzip-compressed output to output_file + '.gz'
+        seq: Read and write CZML text sequences (one packet per line)
+             instead of a single JSON array. Each line is parsed once;
+             the coordinate lists of polylines to simplify are replaced
+             by compact NumPy arrays as they are read, so the full
+             document is never held as Python floats
+        max_vertices: Optional cap on points per polyline (e.g. 256) for
+                      renderers with a primitive budget; simplification
+                      stops at the tolerance or the cap, whichever comes first
     """
+    if compress:
+        output_file += '.gz'
+    
     print(f"\n{'='*60}")
     print(f"Optimizing: {input_file}")
     print(f"Output: {output_file}")
     print(f"Tolerance: {tolerance} radians ({math.degrees(tolerance):.4f} degrees)")
     print(f"{'='*60}")
     
-    # Load CZML
-    print("Loading CZML...")
-    with open(input_file, 'r') as f:
-        czml_data = json.load(f)
+    # Load CZML. Sequences are parsed line by line, so the float lists of
+    # polylines to simplify can be dropped as soon as they are converted.
+    print(f"[{target_name}] Loading CZML...")
+    packet_source = iter_czml_seq(input_file) if seq else load_czml(input_file)
     
     original_size = os.path.getsize(input_file) / (1024 * 1024)
-    print(f"Original size: {original_size:.1f} MB")
-    print(f"Original packets: {len(czml_data)}")
-    
-    # Update document name
-    czml_data[0]['name'] = target_name
+    print(f"[{target_name}] Original size: {original_size:.1f} MB")
     
-    # Process each polyline
-    total_polylines = len(czml_data) - 1
+    # Collect polylines to simplify, keeping each packet without its coordinates
+    czml_data = []
     original_points = 0
     simplified_points = 0
+    simplify_packets = []
+    coords_list = []
     
-    for i in range(1, len(czml_data)):
-        packet = czml_data[i]
+    for packet in packet_source:
+        czml_data.append(packet)
+        if len(czml_data) == 1:
+            continue
         
-        if 'polyline' in packet and 'positions' in packet['polyline']:
-            positions_data = packet['polyline']['positions']
-            
-            if 'cartographicRadians' in positions_data:
-                radians = positions_data['cartographicRadians']
-                original_points += len(radians) // 3
-                
-                # Convert to coordinates
-                coords = cartographic_radians_to_coords(radians)
-                
-                # Simplify
-                simplified_coords = simplify_polyline(coords, tolerance)
-                simplified_points += len(simplified_coords)
-                
-                # Convert back to radians
-                simplified_radians = coords_to_cartographic_radians(simplified_coords)
-                
-                # Update packet
-                packet['polyline']['positions']['cartographicRadians'] = simplified_radians
+        radians = polyline_radians(packet)
+        if radians is None:
+            continue
         
-        if i % 1000 == 0:
-            print(f"Processed {i}/{total_polylines} polylines...")
+        n = len(radians) // 3
+        original_points += n
+        
+        if needs_simplify(n, max_vertices):
+            coords_list.append(cartographic_radians_to_coords(radians))
+            simplify_packets.append(packet)
+            
+            # Only the coordinate array is kept until the packet is rewritten
+            packet['polyline']['positions']['cartographicRadians'] = None
+        else:
+            simplified_points += n
+    
+    del packet_source
+    total_polylines = len(czml_data) - 1
+    print(f"[{target_name}] Original packets: {len(czml_data)}")
+    
+    # Simplify polylines in chunks spread across worker processes
+    print(f"[{target_name}] Simplifying {len(coords_list)} polylines...")
+    chunks = [coords_list[i:i + POLYLINES_PER_CHUNK]
+              for i in range(0, len(coords_list), POLYLINES_PER_CHUNK)]
+    
+    if workers == 1 or len(chunks) <= 1:
+        simplified_chunks = [simplify_chunk(chunk, tolerance, max_vertices) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            simplified_chunks = list(executor.map(simplify_chunk, chunks,
+                                                  [tolerance] * len(chunks),
+                                                  [max_vertices] * len(chunks)))
+    
+    simplified_list = [coords for chunk in simplified_chunks for coords in chunk]
+    simplified_points += sum(len(coords) for coords in simplified_list)
+    del coords_list, chunks, simplified_chunks
+    
+    # Splice simplified coordinates back into their packets
+    for packet, simplified_coords in zip(simplify_packets, simplified_list):
+        simplified_radians = coords_to_cartographic_radians(simplified_coords)
+        packet['polyline']['positions']['cartographicRadians'] = simplified_radians
+    
+    # Update document name
+    czml_data[0]['name'] = target_name
     
     # Write optimized CZML
-    print("\nWriting optimized CZML...")
-    with open(output_file, 'w') as f:
-        json.dump(czml_data, f, separators=(',', ':'))
+    print(f"\n[{target_name}] Writing optimized CZML...")
+    with open_czml(output_file, 'wb') as f:
+        if seq:
+            for packet in czml_data:
+                f.write(orjson.dumps(packet, option=orjson.OPT_APPEND_NEWLINE))
+        else:
+            f.write(orjson.dumps(czml_data))
     
     # Statistics
     optimized_size = os.path.getsize(output_file) / (1024 * 1024)
     reduction = ((original_size - optimized_size) / original_size) * 100
     point_reduction = ((original_points - simplified_points) / original_points) * 100
     
-    print(f"\n{'='*60}")
-    print("OPTIMIZATION COMPLETE")
-    print(f"{'='*60}")
-    print(f"Original size:     {original_size:.1f} MB")
-    print(f"Optimized size:    {optimized_size:.1f} MB")
-    print(f"Size reduction:    {reduction:.1f}%")
-    print(f"\nOriginal points:   {original_points:,}")
-    print(f"Optimized points:  {simplified_points:,}")
-    print(f"Point reduction:   {point_reduction:.1f}%")
-    print(f"\nPolylines:         {total_polylines}")
-    print(f"Avg points/line:   {simplified_points/total_polylines:.1f}")
+    # Printed in one call so parallel levels don't interleave their summaries
+    print(f"\n{'='*60}\n"
+          f"OPTIMIZATION COMPLETE: {target_name}\n"
+          f"{'='*60}\n"
+          f"Original size:     {original_size:.1f} MB\n"
+          f"Optimized size:    {optimized_size:.1f} MB\n"
+          f"Size reduction:    {reduction:.1f}%\n"
+          f"\nOriginal points:   {original_points:,}\n"
+          f"Optimized points:  {simplified_points:,}\n"
+          f"Point reduction:   {point_reduction:.1f}%\n"
+          f"\nPolylines:         {total_polylines}\n"
+          f"Avg points/line:   {simplified_points/total_polylines:.1f}")
     
     return {
         'original_size_mb': original_size,
@@ -136,7 +344,40 @@ def optimize_czml(input_file, output_file, tolerance, target_name):
         'point_reduction_percent': point_reduction
     }
 
+def optimize_one(opt):
+    """Run a single optimization level from main(); executed in a worker process."""
+    input_file = opt['input']
+    if not os.path.exists(input_file) and os.path.exists(input_file + '.gz'):
+        input_file += '.gz'
+    
+    if not os.path.exists(input_file):
+        print(f"\nWARNING: Input file not found: {opt['input']}")
+        return None
+    
+    result = optimize_czml(
+        input_file,
+        opt['output'],
+        opt['tolerance'],
+        opt['name'],
+        opt['workers'],
+        opt['compress'],
+        opt['seq'],
+        opt['max_vertices']
+    )
+    result['output_file'] = opt['output'] + ('.gz' if opt['compress'] else '')
+    result['tolerance'] = opt['tolerance']
+    return result
+
 def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--gzip', action='store_true',
+                        help='write gzip-compressed .czml.gz files')
+    parser.add_argument('--seq', action='store_true',
+                        help='read and write CZML text sequences (.czmls, one packet per line)')
+    parser.add_argument('--max-vertices', type=int, default=None,
+                        help='cap the number of points kept per polyline (e.g. 256)')
+    args = parser.parse_args()
+    
     print("="*60)
     print("CZML OPTIMIZATION TOOL")
     print("Simplify polylines while maintaining visual quality")
@@ -164,22 +405,20 @@ def main():
         }
     ]
     
-    results = []
-    
+    # Run each optimization level in its own process, sharing the
+    # remaining cores between their simplification pools
+    workers = max(1, (os.cpu_count() or 1) // len(optimizations))
     for opt in optimizations:
-        if not os.path.exists(opt['input']):
-            print(f"\nWARNING: Input file not found: {opt['input']}")
-            continue
-        
-        result = optimize_czml(
-            opt['input'],
-            opt['output'],
-            opt['tolerance'],
-            opt['name']
-        )
-        result['output_file'] = opt['output']
-        result['tolerance'] = opt['tolerance']
-        results.append(result)
+        opt['workers'] = workers
+        opt['compress'] = args.gzip
+        opt['seq'] = args.seq
+        opt['max_vertices'] = args.max_vertices
+        if args.seq:
+            opt['input'] += 's'
+            opt['output'] += 's'
+    
+    with ProcessPoolExecutor(max_workers=len(optimizations)) as executor:
+        results = [result for result in executor.map(optimize_one, optimizations) if result]
     
     # Summary
     print("\n" + "="*60)